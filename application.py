@@ -3,6 +3,7 @@
 
 import numpy as np
 import pandas as pd
+import os
 import tempfile
 import pickle
 import joblib
@@ -10,15 +11,23 @@ import json
 import itertools
 import configparser
 import requests
+import orjson
 import math
+import hashlib
+import functools
+import threading
+import uuid
 import s3fs
 import configparser
 from docplex.mp.model import Model
 from docplex.mp.context import Context
-from scipy.stats import t
+from docplex.mp.solution import SolveSolution
+from scipy.special import stdtr
 from datetime import datetime
-from collections import defaultdict
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, make_response, request
 from flask_restful import Resource, Api, reqparse
 from flask_cors import CORS, cross_origin
 from flask_sqlalchemy import SQLAlchemy
@@ -27,12 +36,35 @@ from flask_sqlalchemy import SQLAlchemy
 s3fs.S3FileSystem.read_timeout = 5184000  # one day
 s3fs.S3FileSystem.connect_timeout = 5184000  # one day
 s3 = s3fs.S3FileSystem(anon=False)
+
+# Configuration files are cached on local disk together with their S3 ETag
+# A file is downloaded again only when it changed on S3, so restarts skip the downloads
+# The cache is kept beside the application, and only used if the service owns it and no one else can write to it,
+# since a replaced configuration file with a matching ETag would be read on the next start
+s3_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'w210cache')
+os.makedirs(s3_cache_dir, mode=0o700, exist_ok=True)
+s3_cache_stat = os.stat(s3_cache_dir)
+if (s3_cache_stat.st_uid != os.getuid()) or (s3_cache_stat.st_mode & 0o022):
+    print('Configuration cache directory not owned by the service or writable by other users, using a private one.')
+    s3_cache_dir = tempfile.mkdtemp(prefix='w210cache')
+
+def cachedS3Get(key, local_path):
+    etag = s3.info(key)['ETag']
+    etag_path = os.path.join(s3_cache_dir, os.path.basename(local_path)+'.etag')
+    if os.path.exists(local_path) and os.path.exists(etag_path):
+        with open(etag_path) as etag_file:
+            if etag_file.read() == etag:
+                return
+    s3.get(key, local_path)
+    with open(etag_path, 'w') as etag_file:
+        etag_file.write(etag)
+
 config_file = 'w210policedata/config/optimization.ini'
 try:
-    temp_file = tempfile.NamedTemporaryFile(delete=True)
-    s3.get(config_file,temp_file.name)
+    local_config_file = os.path.join(s3_cache_dir,'optimization.ini')
+    cachedS3Get(config_file,local_config_file)
     config = configparser.ConfigParser()
-    config.read(temp_file.name)
+    config.read(local_config_file)
 except:
     print('Failed to load service configuration file.')
     print('Creating new file with default values.')
@@ -44,23 +76,51 @@ except:
     s3.put(temp_file.name,config_file)
     temp_file.close()
 ml_endpoint = config['GENERAL']['MLServiceEndpoint']
+# Snapshots of the deployment plan are only kept when a file is configured for them
+# The snapshot is unpickled on startup, so it must be in a directory only the service can write to
+plan_snapshot_file = config['GENERAL'].get('PlanSnapshotFile', fallback=None)
+
+# HTTP session to the Machine Learning service
+# Connections are pooled and kept alive instead of opening a new one on every plan load
+# Failed connection attempts are retried with a short backoff
+ml_session = requests.Session()
+ml_session.headers.update({'Connection': 'keep-alive'})
+ml_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+ml_session.mount('http://', ml_adapter)
+ml_session.mount('https://', ml_adapter)
+ml_predict_url = ml_endpoint+'/predict'
+
+# JSON-encoded weekday and week of the year arguments of the prediction service, built once
+weekday_json = {weekday: json.dumps([weekday]) for weekday in range(7)}
+weekyear_json = {weekyear: json.dumps([weekyear]) for weekyear in range(1,54)}
 
 ### Load CPLEX configuration file and library
 config_file = 'w210policedata/config/docloud_config.py'
 try:
-    s3.get(config_file,'docloud_config.py')
+    cachedS3Get(config_file,'docloud_config.py')
 except:
     print('Failed to load DOCplexCloud config file. CPLEX Optimization will not be available.')
 
 ### Load Flask configuration file
 config_file = 'w210policedata/config/config.py'
 try:
-    s3.get(config_file,'config.py')
+    cachedS3Get(config_file,'config.py')
 except:
     print('Failed to load application configuration file!')
 
 application = Flask(__name__)
 api = Api(application)
+
+# Serialize API responses with orjson instead of the standard json encoder
+# Integer keys (community codes and ids) become strings, as with the standard encoder
+orjson_options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+@api.representation('application/json')
+def outputJson(data, code, headers=None):
+    response = make_response(orjson.dumps(data, option=orjson_options), code)
+    response.headers.extend(headers or {})
+    return response
+
 application.config.from_pyfile('config.py')
 db = SQLAlchemy(application)
 
@@ -93,6 +153,7 @@ class PoliceDistrict(db.Model):
 
 class Distance(db.Model):
     __tablename__ = 'distances'
+    __table_args__ = (db.Index('ix_distances_district_community', 'district', 'community'),)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255))
     district = db.Column(db.Integer, db.ForeignKey('policedistrict.id'))
@@ -106,6 +167,7 @@ class Distance(db.Model):
 
 class PatrolDeployment(db.Model):
     __tablename__ = 'patroldeployment'
+    __table_args__ = (db.Index('ix_patroldeployment_date_period', 'date', 'period'),)
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date)
     period = db.Column(db.String(255))
@@ -128,15 +190,54 @@ period = None
 communities = None
 policeDistricts = None
 deployments = None
-distances = None
+deploy_totals = None
+comm_ids = None
+comm_idx = None
+dist_ids = None
+dist_idx = None
+distance_matrix = None
+district_patrols = None
+ethnicity_mask = None
 crimecounts = None
+comm_codes = None
+coverage_scale = None
 totalCoverage = None
-mapCoverage = None
+total_weighted_crimes = None
+total_deploys = None
 mapCrimes = None
-mapDeploys = None
 distanceCost = None
 fairness = None
 
+# Serialized response of the loaded plan, cleared whenever the plan changes
+cached_plan_response = None
+
+# Police districts as read from the database, as their ids, names and patrols in query order
+# Refreshed when a plan is loaded, so optimizations restore the districts without querying again
+district_cache = None
+
+# Lock guarding the in-memory model
+# Requests served by concurrent threads would otherwise interleave their updates to the plan
+plan_lock = threading.RLock()
+
+def withPlanLock(method):
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with plan_lock:
+            return method(*args, **kwargs)
+    return locked
+
+# Optimization jobs run one at a time on a background thread, keyed by job id until their result is fetched
+# CPLEX releases the interpreter while solving, so the other requests keep being served during a solve
+optimization_executor = ThreadPoolExecutor(max_workers=1)
+optimization_jobs = {}
+
+# Finished jobs whose result is never fetched are dropped, oldest first, once more jobs than this are kept
+max_optimization_jobs = 16
+
+# Model of the last optimization, with the plan and options it was built for
+# Optimizing the same loaded plan again with the same options solves it again instead of rebuilding it
+optimization_model = None
+
 ### Parameters
 
 # Number of crimes one patrol can act upon in a shift
@@ -152,6 +253,15 @@ max_coverage = 200
 # Minimum coverage tolerated in any given community
 min_coverage = 25
 
+# CPLEX solver settings
+# Threads set to 0 lets CPLEX use every core of the machine running the solve, with deterministic parallel search
+cplex_threads = 0
+cplex_parallel_mode = 1
+# Time limit (seconds) at which the solver stops with its best solution
+# The optimality gaps are left at the CPLEX defaults: the objective is dominated by the city-wide coverage term,
+# so a relative gap wide enough to stop early would exceed the penalty, coverage, fairness and distance terms
+cplex_time_limit = 120
+
 # Number of patrols required to act on each type of crime
 crimetype_weights = {
                         'THEFT': 1,
@@ -178,37 +288,53 @@ crimetype_weights = {
                         'DOMESTIC VIOLENCE': 1
                      }
 
+# Crime type weights as a dense array indexed by integer crime type code
+# The last entry is the weight used for crime types not listed above
+crimetype_codes = {crimetype: code for code, crimetype in enumerate(crimetype_weights)}
+crimetype_weights_lut = np.array(list(crimetype_weights.values())+[1], dtype=np.float32)
+
+# Calculation of the total coverage of crimes
+# Percentage of the weighted crimes acted upon by all deployed patrols, zero if no crimes are predicted
+def calculateTotalCoverage(totalDeploys, totalWeightedCrimes):
+    if totalWeightedCrimes == 0:
+        return 0
+    return (100.0*n_crimes_per_patrol)*totalDeploys/totalWeightedCrimes
+
+# Calculation of the deployment Fairness as a percentage
+# The p-value of the difference of means test below, which is exactly 1 when there is no difference of means
+def calculateFairness(ethnicityMask, deployTotals):
+    # First calculate the t-statistic
+    t_stat, df = calculateFairnessTStat(ethnicityMask, deployTotals)
+    if t_stat == 0:
+        return 100.0
+    # Now assign the p-value as the fairness, converted to percentage value
+    return fairnessPValue(round(abs(float(t_stat)), 6), df) * 100
+
 # Calculation of deployment Fairness
 # Uses a difference of means test as described in https://link.springer.com/article/10.1007%2Fs10618-017-0506-1
-def calculateFairnessTStat(communities, deploymentPlan, cpxMode=False):
-    comm_count = {0: 0, 1: 0}
-    deploy_count = {0: 0, 1: 0}
-
-    for comm in deploymentPlan:
-        if (communities[comm]['ethnicity'] == 0) or (communities[comm]['ethnicity'] == 1):
-            comm_count[1] += 1
-            deploy_count[1] += deploymentPlan[comm]['total']
-        else:
-            comm_count[0] += 1
-            deploy_count[0] += deploymentPlan[comm]['total']
+# Communities are split in two groups by the ethnicity mask, deployment totals are given in the same order
+def calculateFairnessTStat(ethnicityMask, deployTotals, cpxMode=False):
+    totals = np.asarray(deployTotals, dtype=np.float64)
+    group = ethnicityMask.astype(np.int8)
+    comm_count = np.bincount(group, minlength=2)
+    deploy_count = np.bincount(group, weights=totals, minlength=2)
 
-    df = comm_count[0]+comm_count[1]-2
+    df = int(comm_count.sum())-2
 
     if not cpxMode:
         if (deploy_count[0] == 0) and (deploy_count[1] == 0):
             return 0, df
+        # A group with less than two communities has no variance to test against, so no difference is reported
+        if (comm_count[0] < 2) or (comm_count[1] < 2):
+            return 0, df
 
-    means = {0: deploy_count[0]/comm_count[0], 1: deploy_count[1]/comm_count[1]}
-
-    variances = {0: 0, 1: 0}
+    means = deploy_count/comm_count
 
-    for comm in deploymentPlan:
-        if (communities[comm]['ethnicity'] == 0) or (communities[comm]['ethnicity'] == 1):
-            variances[1] += (deploymentPlan[comm]['total']-means[1])**2
-        else:
-            variances[0] += (deploymentPlan[comm]['total']-means[0])**2
+    if not cpxMode:
+        if means[0] == means[1]:
+            return 0, df
 
-    variances = {0: variances[0]/(comm_count[0]-1), 1: variances[1]/(comm_count[1]-1)}
+    variances = np.bincount(group, weights=(totals-means[group])**2, minlength=2)/(comm_count-1)
 
     sigma = ((((comm_count[0]-1)*(variances[0]**2))+((comm_count[1]-1)*(variances[1]**2)))/(comm_count[0]+comm_count[1]-2))**0.5
 
@@ -216,6 +342,135 @@ def calculateFairnessTStat(communities, deploymentPlan, cpxMode=False):
 
     return t, df
 
+# Two-sided p-value of the fairness t-statistic
+# Evaluates the Student t CDF at the negated statistic, which by symmetry equals its survival function
+# and stays accurate for large statistics. The special function skips the scipy.stats distribution wrapper.
+# Memoized since the statistic is rounded by the callers and repeats across requests with the same number of communities
+@functools.lru_cache(maxsize=4096)
+def fairnessPValue(t_stat, df):
+    return float(2*stdtr(df, -t_stat))
+
+# Reads the police districts from the database into the district cache
+def refreshDistrictCache():
+    global district_cache
+    rows = db.session.query(PoliceDistrict.id, PoliceDistrict.name, PoliceDistrict.patrols).all()
+    district_cache = ([row[0] for row in rows], [row[1] for row in rows], np.array([row[2] for row in rows], dtype=np.int32))
+    return district_cache
+
+# Police district data returned to the dashboard
+# Only the total patrols of each district are stored, deployed patrols are the column sums of the plan
+# and available patrols are derived from both
+def districtPayload(di, deployed):
+    dist_id = dist_ids[di]
+    return {'id':dist_id,'name':policeDistricts[dist_id]['name'],'total_patrols':int(district_patrols[di]),
+            'available_patrols':int(district_patrols[di]-deployed),'deployed_patrols':int(deployed)}
+
+def districtsPayload():
+    deployed = deployments.sum(axis=0)
+    available = district_patrols-deployed
+    return {dist_id: {'id':dist_id,'name':policeDistricts[dist_id]['name'],'total_patrols':int(district_patrols[di]),
+                      'available_patrols':int(available[di]),'deployed_patrols':int(deployed[di])}
+            for di, dist_id in enumerate(dist_ids)}
+
+# Changes to one community and district of the plan, returned instead of the whole plan when requested
+def deltaPayload(ci, di):
+    comm_total = int(deploy_totals[ci])
+    return {'delta':{'community':comm_codes[ci],'mapCoverage':comm_total*float(coverage_scale[ci]),'mapDeploys':comm_total,
+                     'district':districtPayload(di, deployments[:,di].sum()),'distanceCost':distanceCost,
+                     'fairness':fairness,'totalCoverage':totalCoverage},'result':'success'}
+
+# Data of the loaded deployment plan returned to the dashboard
+# Coverage and deploys on the map follow from the community totals, so they are only built here
+def planPayload():
+    mapCoverage = dict(zip(comm_codes, (deploy_totals*coverage_scale).tolist()))
+    mapDeploys = dict(zip(comm_codes, deploy_totals.tolist()))
+    return {'communities':communities,'districts':districtsPayload(),'mapCoverage':mapCoverage,
+            'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
+            'fairness':fairness,'totalCoverage':totalCoverage,'result':'success'}
+
+# Response with the serialized loaded plan
+# The plan is serialized once after each change and the bytes are reused until it changes again
+def planResponse():
+    global cached_plan_response
+    if cached_plan_response is None:
+        cached_plan_response = orjson.dumps(planPayload(), option=orjson_options)
+    response = application.response_class(cached_plan_response, mimetype='application/json')
+    response.set_etag(hashlib.blake2b(cached_plan_response, digest_size=16).hexdigest())
+    return response.make_conditional(request)
+
+# Snapshot of the in-memory model on local disk, in the configured PlanSnapshotFile
+# A restarted worker restores the last loaded or saved plan from it instead of starting empty
+plan_snapshot_vars = ['date','period','communities','policeDistricts','comm_ids','comm_idx','dist_ids','dist_idx',
+                      'distance_matrix','district_patrols','ethnicity_mask','deployments','deploy_totals','comm_codes','crimecounts','coverage_scale',
+                      'total_weighted_crimes','total_deploys',
+                      'totalCoverage','mapCrimes','distanceCost','fairness']
+
+def savePlanSnapshot():
+    if plan_snapshot_file is None:
+        return
+    try:
+        joblib.dump({name: globals()[name] for name in plan_snapshot_vars}, plan_snapshot_file, compress=3)
+    except Exception:
+        print('Failed to save deployment plan snapshot.')
+
+def loadPlanSnapshot():
+    global loaded
+    if (plan_snapshot_file is None) or not os.path.exists(plan_snapshot_file):
+        return
+    # Only a file owned by the service and not writable by others is trusted to be unpickled
+    snapshot_stat = os.stat(plan_snapshot_file)
+    if (snapshot_stat.st_uid != os.getuid()) or (snapshot_stat.st_mode & 0o022):
+        print('Ignoring deployment plan snapshot not owned by the service or writable by other users.')
+        return
+    try:
+        snapshot = joblib.load(plan_snapshot_file)
+    except Exception:
+        print('Failed to load deployment plan snapshot.')
+        return
+    if set(snapshot) != set(plan_snapshot_vars):
+        return
+    globals().update(snapshot)
+    loaded = True
+    print('Restored deployment plan of '+str(date)+' '+str(period)+' from snapshot. Reload it to pick up newer predictions and saved deployments.')
+
+### Request argument parsers
+# Built once at startup and shared by all requests instead of being rebuilt on every call
+# The dashboard sends text arguments JSON encoded, they are decoded and converted while parsing
+
+def jsonArgument(value):
+    return json.loads(value)
+
+def jsonIntArgument(value):
+    return int(json.loads(value))
+
+def jsonDateArgument(value):
+    return datetime.strptime(json.loads(value),'%m-%d-%Y').date()
+
+# Date and period of the deployment plan to load
+load_plan_parser = reqparse.RequestParser()
+load_plan_parser.add_argument('date', type=jsonDateArgument, help='Invalid date argument. Expected format: MM-DD-YYYY.')
+load_plan_parser.add_argument('period', type=jsonArgument)
+
+# District, community and number of patrols to deploy or undeploy
+patrols_parser = reqparse.RequestParser()
+patrols_parser.add_argument('district', type=jsonIntArgument)
+patrols_parser.add_argument('community', type=jsonIntArgument)
+patrols_parser.add_argument('patrols', type=jsonIntArgument)
+patrols_parser.add_argument('delta', type=jsonArgument)
+
+# Patrol moves applied together, as a list of district, community and patrols
+moves_parser = reqparse.RequestParser()
+moves_parser.add_argument('moves', type=jsonArgument)
+
+# Options of the optimization model
+optimization_parser = reqparse.RequestParser()
+optimization_parser.add_argument('useFairness', type=jsonArgument)
+optimization_parser.add_argument('minOnePatrolPerComm', type=jsonArgument)
+
+# Job id returned when an optimization is started
+optimization_status_parser = reqparse.RequestParser()
+optimization_status_parser.add_argument('job', type=jsonArgument)
+
 # Checks if the service is running
 class checkService(Resource):
     def get(self):
@@ -225,6 +480,8 @@ class checkService(Resource):
 # Checks if a deployment plan is already loaded
 # If it is, return the deployment plan being worked on
 class getLoadedDeploymentPlan(Resource):
+    method_decorators = [withPlanLock]
+
     def get(self):
         # Check if there is already a deployment plan loaded and the date and time
         global loaded
@@ -232,50 +489,141 @@ class getLoadedDeploymentPlan(Resource):
         global period
         global communities
         global policeDistricts
-        global distances
+        global comm_ids
+        global comm_idx
+        global dist_ids
+        global dist_idx
+        global distance_matrix
+        global district_patrols
+        global ethnicity_mask
         global deployments
+        global deploy_totals
         global crimecounts
+        global comm_codes
+        global coverage_scale
         global totalCoverage
-        global mapCoverage
+        global total_weighted_crimes
+        global total_deploys
         global mapCrimes
-        global mapDeploys
         global distanceCost
         global fairness
+        global cached_plan_response
 
         if not loaded:
             return {'message':'No Deployment Plan loaded.','result': 'failed'}
         else:
-            return {'communities':communities,'districts':policeDistricts,'mapCoverage':mapCoverage,
-                    'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
-                    'fairness':fairness,'totalCoverage':totalCoverage,'result':'success'}
+            # The dashboard polls this endpoint, so it reuses the serialized plan
+            return planResponse()
+
+# Reads the deployment plan of a day and period with its crime predictions and KPIs
+# Runs without holding the plan lock, so the Machine Learning service and database calls do not block other requests
+# Returns the state of the in-memory model for the plan, or None if the crime predictions could not be loaded
+def readDeploymentPlan(date, period):
+
+    # Get crime counts from the machine learning service
+    weekday = date.weekday()
+    weekyear = date.isocalendar()[1]
+    payload = {'weekday':weekday_json[weekday],'weekyear':weekyear_json[weekyear],'hourday':json.dumps([period])}
+    try:
+        r = ml_session.post(ml_predict_url, data=payload, timeout=(3,30))
+        crimepreds = orjson.loads(r.content)['result']
+    except:
+        return None
+
+    # Load the model from the database
+    communities = {}
+    policeDistricts = {}
+
+    # Build the KPIs to draw on dashboard
+    totalCoverage = 0
+    distanceCost = 0
+    fairness = 0
+
+    # Get the communities
+    # Only the needed columns are fetched, so rows come back as plain tuples instead of ORM objects
+    for comm_id, comm_code, comm_name, comm_ethnicity in db.session.query(Community.id, Community.code, Community.name, Community.ethnicity):
+        communities[comm_id] = {'id':comm_id,'code':comm_code,'name':comm_name,'ethnicity':comm_ethnicity}
+    comm_codes = [community['code'] for community in communities.values()]
+
+    # Get crime predictions from arguments and calculate absolute and weighted count of crimes
+    preds = pd.DataFrame(crimepreds, columns=['communityArea','primaryType','pred'])
+    preds = preds[preds['communityArea'].notna() & preds['primaryType'].notna() & (preds['communityArea'] != '0')]
+    area_codes = preds['communityArea'].astype(int).to_numpy()
+    # Crime types are mapped once to integer codes and weighted through the lookup array
+    type_codes = preds['primaryType'].map(crimetype_codes).fillna(-1).astype(int).to_numpy()
+    pred_counts = preds['pred'].to_numpy(dtype=np.float64)
+    # Sum predictions per community code with a single scatter-add over all predictions
+    n_codes = max(comm_codes)+1 if comm_codes else 0
+    absolute_counts = np.bincount(area_codes, weights=pred_counts, minlength=n_codes).tolist()
+    weighted_counts = np.bincount(area_codes, weights=pred_counts*crimetype_weights_lut[type_codes], minlength=n_codes).tolist()
+    # Counts of each community are then filled in one pass over the summed arrays
+    crimecounts = {comm_code: {'absolute_count':absolute_counts[comm_code],'weighted_count':weighted_counts[comm_code]}
+                   for comm_code in comm_codes}
+    mapCrimes = {comm_code: absolute_counts[comm_code] for comm_code in comm_codes}
+
+    # Coverage percentage added by each deployed patrol in a community, in community order
+    # Precomputed once so the coverage of the whole map is a single multiplication
+    weighted_codes = np.array([crimecounts[comm_code]['weighted_count'] for comm_code in comm_codes], dtype=np.float64)
+    coverage_scale = np.divide(100.0*n_crimes_per_patrol, weighted_codes, out=np.zeros_like(weighted_codes), where=weighted_codes != 0)
+
+    # Get the police districts
+    pd_ids, pd_names, pd_patrols = refreshDistrictCache()
+    for pd_id, pd_name, pd_total in zip(pd_ids, pd_names, pd_patrols.tolist()):
+        policeDistricts[pd_id] = {'id':pd_id,'name':pd_name,'total_patrols':pd_total}
+
+    # Index communities and districts by their position in the dense arrays
+    comm_ids = list(communities)
+    comm_idx = {comm_id: i for i, comm_id in enumerate(comm_ids)}
+    dist_ids = list(policeDistricts)
+    dist_idx = {dist_id: i for i, dist_id in enumerate(dist_ids)}
+    district_patrols = pd_patrols.copy()
+    # Communities in the ethnicity group 0 or 1 form one group of the fairness test, all others the second group
+    ethnicity_mask = np.array([communities[comm_id]['ethnicity'] in (0,1) for comm_id in comm_ids], dtype=bool)
+
+    # Get distances between districts and communities as a community x district matrix
+    distance_matrix = np.zeros((len(comm_ids),len(dist_ids)), dtype=np.float64)
+    for dist_district, dist_community, dist_distance in db.session.query(Distance.district, Distance.community, Distance.distance):
+        distance_matrix[comm_idx[dist_community],dist_idx[dist_district]] = dist_distance
+
+    # Get deployments as a community x district matrix of patrols
+    deployments = np.zeros((len(comm_ids),len(dist_ids)), dtype=np.int32)
+    for deploy_community, deploy_district, deploy_patrols in db.session.query(PatrolDeployment.community, PatrolDeployment.district, PatrolDeployment.patrols)\
+                                                                    .filter(PatrolDeployment.date==date)\
+                                                                    .filter(PatrolDeployment.period==period)\
+                                                                    .yield_per(1000):
+        deployments[comm_idx[deploy_community],dist_idx[deploy_district]] += deploy_patrols
+
+    # Calculate crime statistics for the map with whole-matrix reductions
+    # Patrols deployed to each community are kept alongside the plan and adjusted with it
+    deploy_totals = deployments.sum(axis=1, dtype=np.int32)
+    distanceCost = float(np.einsum('ij,ij->', deployments, distance_matrix))
+
+    # Calculate the total coverage of Crimes
+    # Totals are kept so deploying and undeploying patrols only need to adjust them
+    total_weighted_crimes = float(weighted_codes.sum())
+    total_deploys = int(deploy_totals.sum())
+    totalCoverage = calculateTotalCoverage(total_deploys, total_weighted_crimes)
+
+    # Calculate the deployment Fairness
+    fairness = calculateFairness(ethnicity_mask, deploy_totals)
+
+    return {'date':date,'period':period,'communities':communities,'policeDistricts':policeDistricts,
+            'comm_ids':comm_ids,'comm_idx':comm_idx,'dist_ids':dist_ids,'dist_idx':dist_idx,
+            'distance_matrix':distance_matrix,'district_patrols':district_patrols,'ethnicity_mask':ethnicity_mask,
+            'deployments':deployments,'deploy_totals':deploy_totals,'comm_codes':comm_codes,'crimecounts':crimecounts,
+            'coverage_scale':coverage_scale,'total_weighted_crimes':total_weighted_crimes,'total_deploys':total_deploys,
+            'totalCoverage':totalCoverage,'mapCrimes':mapCrimes,'distanceCost':distanceCost,'fairness':fairness}
 
 # Loads a deployment plan for a specific day and period
 # Returns the data used by the dashboard
 class loadDeploymentPlan(Resource):
     def get(self):
 
-        global date
-        global period
         global loaded
-        global communities
-        global policeDistricts
-        global distances
-        global deployments
-        global crimecounts
-        global totalCoverage
-        global mapCoverage
-        global mapCrimes
-        global mapDeploys
-        global distanceCost
-        global fairness
-        global n_crimes_per_patrol
-        global crimetype_weights
+        global cached_plan_response
 
         # Get the passed date and period of the day
-        argparser = reqparse.RequestParser()
-        argparser.add_argument('date')
-        argparser.add_argument('period')
-        args = argparser.parse_args()
+        args = load_plan_parser.parse_args()
 
         if args['date'] is None:
             return {'message':'Missing date argument. Please pass a date to load the deployment.','result':'failed'}
@@ -286,481 +634,665 @@ class loadDeploymentPlan(Resource):
         # if args['period'] not in ['DAWN','MORNING','AFTERNOON','EVENING']:
         #     return {'message':'Invalid period argument. Supported periods: DAWN, MORNING, AFTERNOON, EVENING.','result':'failed'}
 
-        # Get crime counts from the machine learning service
-        date = datetime.strptime(json.loads(args['date']),'%m-%d-%Y').date()
-        weekday = date.weekday()
-        weekyear = date.isocalendar()[1]
-        period = json.loads(args['period'])
-        payload = {'weekday':json.dumps([weekday]),'weekyear':json.dumps([weekyear]),'hourday':json.dumps([period])}
-        url =ml_endpoint+'/predict'
-        try:
-            r = requests.post(url, data=payload)
-            crimepreds = r.json()['result']
-        except:
+        plan = readDeploymentPlan(args['date'], args['period'])
+        if plan is None:
             return {'message':'Error loading crime predictions from Machine Learning service.','result':'failed'}
 
-        # Load the model from the database to the in-memory model
-        communities = {}
-        policeDistricts = {}
-        deployments = {}
-        distances = {}
-        crimecounts = {}
-
-        # Build the data to plot on the map
-        mapCoverage = {}
-        mapCrimes = {}
-        mapDeploys = {}
-
-        # Build the KPIs to draw on dashboard
-        totalCoverage = 0
-        distanceCost = 0
-        fairness = 0
-
-        # Get the communities and zero crime counts and deployments
-        for comm in db.session.query(Community):
-            communities[comm.id] = {'id':comm.id,'code':comm.code,'name':comm.name,'ethnicity':comm.ethnicity}
-            deployments[comm.id] = defaultdict(int)
-            deployments[comm.id]['total'] = 0
-            crimecounts[communities[comm.id]['code']] = {'absolute_count':0,'weighted_count':0}
-            mapCoverage[communities[comm.id]['code']] = 0
-            mapCrimes[communities[comm.id]['code']] = 0
-            mapDeploys[communities[comm.id]['code']] = 0
-
-        # Get distances between districts and communities
-        for dist in db.session.query(Distance):
-            distances[(dist.district,dist.community)] = dist.distance
-
-        # Get crime predictions from arguments and calculate absolute and weighted count of crimes
-        for pred in crimepreds:
-            if (pred['communityArea'] is not None) and (pred['primaryType'] is not None) and (pred['communityArea'] != '0'):
-                crimecounts[int(pred['communityArea'])]['absolute_count'] += pred['pred']
-                crimecounts[int(pred['communityArea'])]['weighted_count'] += pred['pred']*crimetype_weights[pred['primaryType']]
-                mapCrimes[communities[int(pred['communityArea'])]['code']] = crimecounts[communities[int(pred['communityArea'])]['code']]['absolute_count']
-
-        # Get the police districts
-        for pd in db.session.query(PoliceDistrict):
-            policeDistricts[pd.id] = {'id':pd.id,'name':pd.name,'total_patrols':pd.patrols,'available_patrols':pd.patrols,'deployed_patrols':0}
-
-        # Get deployments, calculating crime statistics for the map
-        for deploy in db.session.query(PatrolDeployment)\
-                                .filter(PatrolDeployment.date==args['date'])\
-                                .filter(PatrolDeployment.period==args['period']):
-            deployments[deploy.community][deploy.district] += deploy.patrols
-            deployments[deploy.community]['total'] += deploy.patrols
-            policeDistricts[deploy.district]['available_patrols'] -= deploy.patrols
-            policeDistricts[deploy.district]['deployed_patrols'] += deploy.patrols
-            if crimecounts[communities[deploy.community]['code']]['weighted_count'] != 0:
-                mapCoverage[communities[deploy.community]['code']] = ((deployments[deploy.community]['total']*n_crimes_per_patrol)/ \
-                                                                     crimecounts[communities[deploy.community]['code']]['weighted_count'])*100
-            else:
-                mapCoverage[communities[deploy.community]['code']] = 0
-            mapDeploys[communities[deploy.community]['code']] = deployments[deploy.community]['total']
-            distanceCost += deploy.patrols*distances[(deploy.district,deploy.community)]
+        # Swap the new plan into the in-memory model, the plan lock is only held for the swap
+        # Other requests see either the previous plan or the new one as a whole
+        with plan_lock:
+            globals().update(plan)
+            cached_plan_response = None
 
-        # Calculate the total coverage of Crimes
-        totalcrimes = 0
-        totaldeploys = 0
-        for comm in deployments:
-            totalcrimes += crimecounts[communities[comm]['code']]['weighted_count']
-            totaldeploys += deployments[comm]['total']
-        totalCoverage = ((totaldeploys*n_crimes_per_patrol)/totalcrimes)*100
+            # Set the deployment plan as loaded
+            loaded = True
+            savePlanSnapshot()
 
-        # Calculate the deployment Fairness
-        # First calculate the t-statistic
-        t_stat, df = calculateFairnessTStat(communities, deployments)
-        # Now assign the p-value as the fairness
-        fairness = (1 - t.cdf(abs(t_stat), df)) * 2
-        # Convert to percentage value
-        fairness = fairness * 100
-
-        # Set the deployment plan as loaded
-        loaded = True
-
-        # Return data to the dashboard
-        return {'communities':communities,'districts':policeDistricts,'mapCoverage':mapCoverage,
-                'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
-                'fairness':fairness,'totalCoverage':totalCoverage,'result':'success'}
+            # Return data to the dashboard
+            return planResponse()
 
 # Deploys patrols from a district to a community, recalculates the KPIs and returns the data to update the dashboard
 class deployPatrols(Resource):
+    method_decorators = [withPlanLock]
+
     def get(self):
 
         global communities
         global policeDistricts
-        global distances
+        global comm_ids
+        global comm_idx
+        global dist_ids
+        global dist_idx
+        global distance_matrix
+        global district_patrols
+        global ethnicity_mask
         global deployments
+        global deploy_totals
         global crimecounts
+        global comm_codes
+        global coverage_scale
         global totalCoverage
-        global mapCoverage
+        global total_weighted_crimes
+        global total_deploys
         global mapCrimes
-        global mapDeploys
         global distanceCost
         global fairness
+        global cached_plan_response
         global n_crimes_per_patrol
         global crimetype_weights
 
         # Check if a deployment plan has already been loaded
-        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distances is None) or not loaded:
+        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distance_matrix is None) or not loaded:
             return {'message':'No deployment plan loaded','result':'failed'}
 
         # Get the passed district, community and number of patrols
-        argparser = reqparse.RequestParser()
-        argparser.add_argument('district')
-        argparser.add_argument('community')
-        argparser.add_argument('patrols')
-        args = argparser.parse_args()
-
-        args['district'] = json.loads(args['district'])
-        args['community'] = json.loads(args['community'])
-        args['patrols'] = json.loads(args['patrols'])
+        args = patrols_parser.parse_args()
 
         # Check arguments
         if (args['district'] is None) or (args['community'] is None) or (args['patrols'] is None):
             return {'message':'Argument missing. Expected arguments: district, community, patrols.','result':'failed'}
 
-        if policeDistricts[int(args['district'])]['available_patrols'] < int(args['patrols']):
+        comm_id = args['community']
+        dist_id = args['district']
+        n_patrols = args['patrols']
+
+        ci = comm_idx[comm_id]
+        di = dist_idx[dist_id]
+
+        # Nothing changes when no patrols are moved, so the KPIs are not recalculated
+        if n_patrols == 0:
+            if args['delta'] == 'yes':
+                return deltaPayload(ci, di)
+            return planResponse()
+
+        if district_patrols[di]-deployments[:,di].sum() < n_patrols:
             return {'message':'Number of patrols to be deployed is higher than number of available patrols.','result':'failed'}
 
         # Update the numbers of deployed patrols
-        deployments[int(args['community'])][int(args['district'])] += int(args['patrols'])
-        deployments[int(args['community'])]['total'] += int(args['patrols'])
-        policeDistricts[int(args['district'])]['available_patrols'] -= int(args['patrols'])
-        policeDistricts[int(args['district'])]['deployed_patrols'] += int(args['patrols'])
+        deployments[ci,di] += n_patrols
+        deploy_totals[ci] += n_patrols
+        cached_plan_response = None
 
         # Recalculate coverage of crimes and other KPIs for the dashboard
-        if crimecounts[communities[int(args['community'])]['code']]['weighted_count'] != 0:
-            mapCoverage[communities[int(args['community'])]['code']] = ((deployments[int(args['community'])]['total']*n_crimes_per_patrol)/ \
-                                                                       crimecounts[communities[int(args['community'])]['code']]['weighted_count'])*100
-        else:
-            mapCoverage[communities[int(args['community'])]['code']] = 0
-        mapDeploys[communities[int(args['community'])]['code']] = deployments[int(args['community'])]['total']
-        distanceCost += int(args['patrols'])*distances[(int(args['district']),int(args['community']))]
+        distanceCost += n_patrols*distance_matrix[ci,di]
 
         # Calculate the total coverage of Crimes
-        totalcrimes = 0
-        totaldeploys = 0
-        for comm in deployments:
-            totalcrimes += crimecounts[communities[comm]['code']]['weighted_count']
-            totaldeploys += deployments[comm]['total']
-        totalCoverage = ((totaldeploys*n_crimes_per_patrol)/totalcrimes)*100
+        total_deploys += n_patrols
+        totalCoverage = calculateTotalCoverage(total_deploys, total_weighted_crimes)
 
         # Calculate the deployment Fairness
-        # First calculate the t-statistic
-        t_stat, df = calculateFairnessTStat(communities, deployments)
-        # Now assign the p-value as the fairness
-        fairness = (1 - t.cdf(abs(t_stat), df)) * 2
-        # Convert to percentage value
-        fairness = fairness * 100
+        fairness = calculateFairness(ethnicity_mask, deploy_totals)
+
+        # If requested, return only what changed so the dashboard can patch its state
+        if args['delta'] == 'yes':
+            return deltaPayload(ci, di)
 
         # Return data to the dashboard
-        return {'communities':communities,'districts':policeDistricts,'mapCoverage':mapCoverage,
-                'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
-                'fairness':fairness,'totalCoverage':totalCoverage,'result':'success'}
+        return planResponse()
 
 class undeployPatrols(Resource):
+    method_decorators = [withPlanLock]
+
     def get(self):
 
         global communities
         global policeDistricts
-        global distances
+        global comm_ids
+        global comm_idx
+        global dist_ids
+        global dist_idx
+        global distance_matrix
+        global district_patrols
+        global ethnicity_mask
         global deployments
+        global deploy_totals
         global crimecounts
+        global comm_codes
+        global coverage_scale
         global totalCoverage
-        global mapCoverage
+        global total_weighted_crimes
+        global total_deploys
         global mapCrimes
-        global mapDeploys
         global distanceCost
         global fairness
+        global cached_plan_response
         global n_crimes_per_patrol
         global crimetype_weights
 
-        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distances is None) or not loaded:
+        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distance_matrix is None) or not loaded:
             return {'message':'No deployment plan loaded','result':'failed'}
 
         # Get the passed district, community and number of patrols
-        argparser = reqparse.RequestParser()
-        argparser.add_argument('district')
-        argparser.add_argument('community')
-        argparser.add_argument('patrols')
-        args = argparser.parse_args()
-
-        args['district'] = json.loads(args['district'])
-        args['community'] = json.loads(args['community'])
-        args['patrols'] = json.loads(args['patrols'])
+        args = patrols_parser.parse_args()
 
         if (args['district'] is None) or (args['community'] is None) or (args['patrols'] is None):
             return {'message':'Argument missing. Expected arguments: district, community, patrols.','result':'failed'}
 
-        if deployments[int(args['community'])][int(args['district'])] < int(args['patrols']):
+        comm_id = args['community']
+        dist_id = args['district']
+        n_patrols = args['patrols']
+
+        ci = comm_idx[comm_id]
+        di = dist_idx[dist_id]
+
+        # Nothing changes when no patrols are moved, so the KPIs are not recalculated
+        if n_patrols == 0:
+            if args['delta'] == 'yes':
+                return deltaPayload(ci, di)
+            return planResponse()
+
+        if deployments[ci,di] < n_patrols:
             return {'message':'Number of patrols deployed is lower than number of patrols to be removed.','result':'failed'}
 
-        deployments[int(args['community'])][int(args['district'])] -= int(args['patrols'])
-        deployments[int(args['community'])]['total'] -= int(args['patrols'])
-        policeDistricts[int(args['district'])]['available_patrols'] += int(args['patrols'])
-        policeDistricts[int(args['district'])]['deployed_patrols'] -= int(args['patrols'])
+        deployments[ci,di] -= n_patrols
+        deploy_totals[ci] -= n_patrols
+        cached_plan_response = None
 
         # Recalculate coverage of crimes and other KPIs for the dashboard
-        if crimecounts[communities[int(args['community'])]['code']]['weighted_count'] != 0:
-            mapCoverage[communities[int(args['community'])]['code']] = ((deployments[int(args['community'])]['total']*n_crimes_per_patrol)/ \
-                                                                       crimecounts[communities[int(args['community'])]['code']]['weighted_count'])*100
-        else:
-            mapCoverage[communities[int(args['community'])]['code']] = 0
-        mapDeploys[communities[int(args['community'])]['code']] = deployments[int(args['community'])]['total']
-        distanceCost -= int(args['patrols'])*distances[(int(args['district']),int(args['community']))]
+        distanceCost -= n_patrols*distance_matrix[ci,di]
 
         # Calculate the total coverage of Crimes
-        totalcrimes = 0
-        totaldeploys = 0
-        for comm in deployments:
-            totalcrimes += crimecounts[communities[comm]['code']]['weighted_count']
-            totaldeploys += deployments[comm]['total']
-        totalCoverage = ((totaldeploys*n_crimes_per_patrol)/totalcrimes)*100
+        total_deploys -= n_patrols
+        totalCoverage = calculateTotalCoverage(total_deploys, total_weighted_crimes)
 
         # Calculate the deployment Fairness
-        # First calculate the t-statistic
-        t_stat, df = calculateFairnessTStat(communities, deployments)
-        # Now assign the p-value as the fairness
-        fairness = (1 - t.cdf(abs(t_stat), df)) * 2
-        # Convert to percentage value
-        fairness = fairness * 100
+        fairness = calculateFairness(ethnicity_mask, deploy_totals)
+
+        # If requested, return only what changed so the dashboard can patch its state
+        if args['delta'] == 'yes':
+            return deltaPayload(ci, di)
 
         # Return data to the dashboard
-        return {'communities':communities,'districts':policeDistricts,'mapCoverage':mapCoverage,
-                'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
-                'fairness':fairness,'totalCoverage':totalCoverage,'result':'success'}
+        return planResponse()
+
+# Applies several patrol moves at once, recalculates the KPIs a single time and returns the data to update the dashboard
+# Positive patrols are deployed from the district to the community, negative patrols are undeployed
+class deployPatrolsBatch(Resource):
+    method_decorators = [withPlanLock]
+
+    def get(self):
+
+        global communities
+        global policeDistricts
+        global comm_ids
+        global comm_idx
+        global dist_ids
+        global dist_idx
+        global distance_matrix
+        global district_patrols
+        global ethnicity_mask
+        global deployments
+        global deploy_totals
+        global crimecounts
+        global comm_codes
+        global coverage_scale
+        global totalCoverage
+        global total_weighted_crimes
+        global total_deploys
+        global mapCrimes
+        global distanceCost
+        global fairness
+        global cached_plan_response
+        global n_crimes_per_patrol
+        global crimetype_weights
+
+        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distance_matrix is None) or not loaded:
+            return {'message':'No deployment plan loaded','result':'failed'}
+
+        # Get the passed list of moves
+        args = moves_parser.parse_args()
+
+        if args['moves'] is None:
+            return {'message':'Argument missing. Expected arguments: moves.','result':'failed'}
+
+        try:
+            moves = [(comm_idx[int(move['community'])], dist_idx[int(move['district'])], int(move['patrols'])) for move in args['moves']]
+        except (KeyError, TypeError, ValueError):
+            return {'message':'Invalid moves argument. Each move expects a district, community and patrols.','result':'failed'}
+
+        # Nothing changes when no patrols are moved, so the KPIs are not recalculated
+        if not any(n_patrols for ci, di, n_patrols in moves):
+            return planResponse()
+
+        # Add all moves to a matrix of changes, repeated pairs are accumulated
+        move_comms, move_dists, move_patrols = (np.array(values) for values in zip(*moves))
+        changes = np.zeros_like(deployments)
+        np.add.at(changes, (move_comms, move_dists), move_patrols.astype(np.int32))
+
+        # The moves are only applied if the resulting plan is valid
+        updated = deployments+changes
+        if (updated < 0).any():
+            return {'message':'Number of patrols deployed is lower than number of patrols to be removed.','result':'failed'}
+        if (updated.sum(axis=0) > district_patrols).any():
+            return {'message':'Number of patrols to be deployed is higher than number of available patrols.','result':'failed'}
+
+        # Update the numbers of deployed patrols
+        deployments = updated
+        deploy_totals += changes.sum(axis=1, dtype=np.int32)
+        cached_plan_response = None
+
+        # Recalculate coverage of crimes and other KPIs for the dashboard
+        distanceCost += float(np.einsum('ij,ij->', changes, distance_matrix))
+
+        # Calculate the total coverage of Crimes
+        total_deploys += int(changes.sum())
+        totalCoverage = calculateTotalCoverage(total_deploys, total_weighted_crimes)
+
+        # Calculate the deployment Fairness
+        fairness = calculateFairness(ethnicity_mask, deploy_totals)
+
+        # Return data to the dashboard
+        return planResponse()
 
 # Persists the deployment plan on the database
 class saveDeploymentPlan(Resource):
+    method_decorators = [withPlanLock]
+
     def get(self):
 
         global date
         global period
+        global comm_ids
+        global dist_ids
         global deployments
 
-        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distances is None) or not loaded:
+        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distance_matrix is None) or not loaded:
             return {'message':'No deployment plan loaded.','result':'failed'}
 
-        # Get all previous entries from the deployment plan
-        for deploy in db.session.query(PatrolDeployment)\
-                                .filter(PatrolDeployment.date==date)\
-                                .filter(PatrolDeployment.period==period):
-            db.session.delete(deploy)
+        # Remove all previous entries from the deployment plan with a single DELETE
+        db.session.query(PatrolDeployment)\
+                  .filter(PatrolDeployment.date==date)\
+                  .filter(PatrolDeployment.period==period)\
+                  .delete(synchronize_session=False)
 
-        # Input new entries from the loaded deployment plan
-        for comm in deployments:
-            for pd in deployments[comm]:
-                if (pd != 'total'):
-                    db.session.add(PatrolDeployment(date=date,period=period,community=comm,district=pd,patrols=deployments[comm][pd]))
+        # Input new entries from the loaded deployment plan in one bulk INSERT
+        # Pairs without patrols are not stored, loading treats them as zero
+        # The insert goes through the table directly, skipping the ORM unit of work
+        rows = [{'date':date,'period':period,'community':comm_ids[ci],'district':dist_ids[di],'patrols':int(deployments[ci,di])}
+                for ci, di in np.argwhere(deployments > 0)]
+        if rows:
+            db.session.execute(PatrolDeployment.__table__.insert(), rows)
 
         db.session.commit()
+        savePlanSnapshot()
 
         return {'message':'Deployment plan saved succesfully.','result':'success'}
 
-# Runs the optimization model on the deployment plan
+# Builds the optimization model on a snapshot of the deployment plan
+def buildOptimizationModel(plan, useFairness, minOnePatrolPerComm):
+    communities = plan['communities']
+    policeDistricts = plan['policeDistricts']
+    comm_ids = plan['comm_ids']
+    dist_ids = plan['dist_ids']
+    dist_idx = plan['dist_idx']
+    distance_matrix = plan['distance_matrix']
+    district_patrols = plan['district_patrols']
+    ethnicity_mask = plan['ethnicity_mask']
+    crimecounts = plan['crimecounts']
+
+    print("Building model...")
+    # Create model
+    context = Context.make_default_context()
+    model = Model(name="CrimeDeployment", context=context)
+
+    print("Creating variables...")
+    # Create model variables
+    # Assignment of patrols from each district to each community is a separate variable
+    # All of them are created in one call, keyed by (community, district)
+    deployments_cpx = model.integer_var_matrix(comm_ids, dist_ids, lb=0,
+                                               ub=lambda key: int(district_patrols[dist_idx[key[1]]]),
+                                               name=lambda key: "c"+str(key[0])+"d"+str(key[1]))
+    # Patrols deployed from each district and deployed to each community
+    # Expressions are always summed with model.sum, which builds them in one pass instead of copying them on each addition
+    deployed_cpx = {dist_id: model.sum(deployments_cpx[comm_id,dist_id] for comm_id in comm_ids) for dist_id in dist_ids}
+    totals_cpx = {comm_id: model.sum(deployments_cpx[comm_id,dist_id] for dist_id in dist_ids) for comm_id in comm_ids}
+    ethnicity_count = {1: int(ethnicity_mask.sum()), 0: len(comm_ids)-int(ethnicity_mask.sum())}
+
+    print("Creating constraints...")
+    # Add model constraints
+    # Sum of deployed units over all communities can't be higher than number of available patrols
+    # Communities and districts are keyed by their id, so their entries are iterated directly
+    for dist_id, district in policeDistricts.items():
+        max_patrols = district['total_patrols']
+        model.add_constraint(deployed_cpx[dist_id] <= max_patrols)
+        model.add_constraint(deployed_cpx[dist_id] >= 0)
+
+    # At least one patrol per community
+    if minOnePatrolPerComm:
+        for comm_id in comm_ids:
+            model.add_constraint(totals_cpx[comm_id] >= 1)
+
+    print("Calculating objective...")
+    print("     - Crime Coverage")
+    # Calculate crime coverage in this deployment
+    # We check the coverage, but also apply a penalty for coverages larger than a set threshold
+    coverages = []
+    coverage_terms = []
+    coverage_coefs = []
+    totalDeployed = []
+    totalCrimes = []
+    ethnicityDeployed = {0: [], 1: []}
+    for comm_id, community in communities.items():
+        # Weighted crimes and patrol total of the community are looked up once
+        weighted_count = crimecounts[community['code']]['weighted_count']
+        comm_total_cpx = totals_cpx[comm_id]
+        if weighted_count != 0:
+            # Patrols are scaled to coverage by a single coefficient, so each coverage expression is built once
+            coverage_coef = n_crimes_per_patrol/weighted_count
+            coverage = comm_total_cpx*coverage_coef
+            coverages.append(coverage)
+            coverage_terms.append(comm_total_cpx)
+            coverage_coefs.append(coverage_coef)
+            totalDeployed.append(comm_total_cpx*n_crimes_per_patrol)
+            totalCrimes.append(weighted_count)
+            if community['ethnicity'] in (0,1):
+                ethnicityDeployed[1].append(comm_total_cpx)
+            else:
+                ethnicityDeployed[0].append(comm_total_cpx)
+
+    # Coverage outside the thresholds is penalized through slack variables above and below them
+    # The objective minimizes the slacks, so each one equals the excess or shortfall of its coverage
+    over_cpx = model.continuous_var_list(len(coverages), lb=0, name='over')
+    under_cpx = model.continuous_var_list(len(coverages), lb=0, name='under')
+    model.add_constraints(coverage-(upper_penalty_threshold/100) <= over for coverage, over in zip(coverages, over_cpx))
+    model.add_constraints((lower_penalty_threshold/100)-coverage <= under for coverage, under in zip(coverages, under_cpx))
+
+    avg_coverage = model.scal_prod(coverage_terms, coverage_coefs)/len(coverages)
+    avg_penalty = (model.sum(over_cpx)+model.sum(under_cpx))/len(coverages)
+    citywideCoverage = model.sum(totalDeployed)/sum(totalCrimes)
+    citywide_over = model.continuous_var(lb=0, name='citywide_over')
+    citywide_under = model.continuous_var(lb=0, name='citywide_under')
+    model.add_constraint(citywideCoverage-(upper_penalty_threshold/100) <= citywide_over)
+    model.add_constraint((lower_penalty_threshold/100)-citywideCoverage <= citywide_under)
+    citywidePenalty = citywide_over+citywide_under
+
+    print("     - Distances")
+    # Calculate the distances units have to drive to fulfill deployments
+    # Variables are listed in the row-major order of the distance matrix, so both line up when flattened
+    deployments_flat = [deployments_cpx[comm,dist] for comm in comm_ids for dist in dist_ids]
+    distanceCost_cpx = model.scal_prod(deployments_flat, distance_matrix.ravel().tolist())
+
+    print("     - Combined Objective")
+    # Now build the objective function
+    obj = 1000000000*citywidePenalty-1000000000*citywideCoverage+1000000*avg_penalty-100000*avg_coverage+distanceCost_cpx
+    if useFairness:
+        print("     - Add Fairness Statistic to Combined Objective")
+        # Add model objective
+        # First calculate the fairness of the deployment
+        # The absolute difference of the group means is split into its positive and negative parts
+        fairness_pos = model.continuous_var(lb=0, name='fairness_pos')
+        fairness_neg = model.continuous_var(lb=0, name='fairness_neg')
+        model.add_constraint((model.sum(ethnicityDeployed[0])/ethnicity_count[0])-(model.sum(ethnicityDeployed[1])/ethnicity_count[1]) == fairness_pos-fairness_neg)
+        fairness_cpx = fairness_pos+fairness_neg
+        obj = 10000*fairness_cpx+obj
+
+    #model.add(maximize(obj))
+    model.minimize(obj)
+
+    print("Adding KPIs...")
+    # Add the KPIs we're interested in tracking
+    model.add_kpi(citywideCoverage, publish_name="City-wide Coverage")
+    model.add_kpi(citywidePenalty, publish_name="City-wide Coverage Penalty")
+    model.add_kpi(avg_coverage, publish_name="Avg. Coverage")
+    model.add_kpi(avg_penalty, publish_name="Avg. Coverage Penalty")
+    model.add_kpi(distanceCost_cpx, publish_name="Total Distance")
+    if useFairness:
+        model.add_kpi(fairness_cpx, publish_name="Fairness Simple Mean Difference")
+    model.add_kpi(obj, publish_name="Combined Objective")
+
+    print("Model ready:")
+    model.print_information()
+
+    # Solver settings
+    model.parameters.threads = cplex_threads
+    model.parameters.parallel = cplex_parallel_mode
+    model.parameters.timelimit = cplex_time_limit
+
+    return model, deployments_cpx, deployments_flat
+
+# Solves the optimization model on a snapshot of the deployment plan
+# Runs in the optimization worker outside the plan lock, so it only reads the snapshot taken when the job started
+def solveOptimization(plan, useFairness, minOnePatrolPerComm):
+    global optimization_model
+
+    comm_ids = plan['comm_ids']
+    dist_ids = plan['dist_ids']
+    deployments = plan['deployments']
+
+    # The last model is reused for the same plan, options and district patrols
+    # Crime counts are compared by identity since they are replaced whenever a plan is loaded
+    # Only the single optimization worker touches the model, so it needs no lock
+    model_key = (plan['date'], plan['period'], useFairness, minOnePatrolPerComm, tuple(plan['district_patrols'].tolist()))
+    if (optimization_model is not None) and (optimization_model['key'] == model_key) and (optimization_model['crimecounts'] is plan['crimecounts']):
+        print("Reusing model...")
+        model = optimization_model['model']
+        deployments_cpx = optimization_model['deployments_cpx']
+        deployments_flat = optimization_model['deployments_flat']
+    else:
+        # Release the solver resources of the model being replaced
+        if optimization_model is not None:
+            optimization_model['model'].end()
+            optimization_model = None
+        model, deployments_cpx, deployments_flat = buildOptimizationModel(plan, useFairness, minOnePatrolPerComm)
+        optimization_model = {'key':model_key,'crimecounts':plan['crimecounts'],'model':model,
+                              'deployments_cpx':deployments_cpx,'deployments_flat':deployments_flat}
+
+    # Warm start the solver with the deployment plan currently in memory
+    # CPLEX then has an incumbent from the first node, or repairs it if it violates the new constraints
+    # A plan without deployments gives no start, docplex rejects an empty one
+    # Starts of earlier runs on a reused model are stale and are dropped first
+    model.clear_mip_starts()
+    if deployments.any():
+        mip_start = SolveSolution(model)
+        for ci, di in np.argwhere(deployments > 0):
+            mip_start.add_var_value(deployments_cpx[comm_ids[ci],dist_ids[di]], int(deployments[ci,di]))
+        model.add_mip_start(mip_start)
+
+    print("Solving problem...")
+    # Solve the problem
+    msol = model.solve()
+
+    print("Done! Getting results...")
+    # Get result from solve
+    # if msol.solve_details['status']:
+    #     return {'solve_status':msol.get_solve_status(),'message':'Optimization executed but aborted due to exceeding maximum run time.','result':'failed'}
+
+    if msol is None:
+        return {'message':'Optimization did not find a feasible deployment plan.','result':'failed'}
+
+    # Get solution and place in deployments
+    model.report()
+    print(msol.solve_details)
+
+    # All solution values are read in one call, in the row-major order of the plan matrix
+    # Solver values of integer variables are floats, round them before storing in the integer plan
+    solution = np.rint(np.array(msol.get_values(deployments_flat), dtype=np.float64)).astype(np.int32).reshape(len(comm_ids),len(dist_ids))
+
+    # Place the solution in the plan in memory, holding the plan lock as the request handlers do
+    with application.app_context():
+        with plan_lock:
+            return applyOptimization(plan, solution, msol.solve_details.status)
+
+# Replaces the loaded deployment plan with the solution of the optimization model and recalculates the KPIs
+def applyOptimization(plan, solution, solve_status):
+
+    global date
+    global period
+    global loaded
+    global communities
+    global policeDistricts
+    global comm_ids
+    global comm_idx
+    global dist_ids
+    global dist_idx
+    global distance_matrix
+    global district_patrols
+    global ethnicity_mask
+    global deployments
+    global deploy_totals
+    global crimecounts
+    global comm_codes
+    global coverage_scale
+    global totalCoverage
+    global total_weighted_crimes
+    global total_deploys
+    global mapCrimes
+    global distanceCost
+    global fairness
+    global cached_plan_response
+    global n_crimes_per_patrol
+    global crimetype_weights
+    global district_cache
+
+    # A different plan may have been loaded while the model was solving, the solution does not apply to it
+    # Reloading the same date and period replaces the crime counts, which are compared by identity
+    # Patrols deployed or undeployed during the solve would be lost, so an edited plan is not replaced either
+    if (not loaded) or (date != plan['date']) or (period != plan['period']) or (comm_ids != plan['comm_ids']) or (dist_ids != plan['dist_ids'])\
+       or (crimecounts is not plan['crimecounts']) or not np.array_equal(deployments, plan['deployments']):
+        return {'message':'Deployment plan changed during the optimization. Please run the optimization again.','result':'failed'}
+
+    # First reset any plan existing in memory and its KPIs
+    cached_plan_response = None
+    totalCoverage = 0
+    distanceCost = 0
+    fairness = 0
+    # Districts come from the cache filled on load, a worker restored from a snapshot reads them once
+    if district_cache is None:
+        refreshDistrictCache()
+    pd_ids, pd_names, pd_patrols = district_cache
+    for pd_id, pd_name, pd_total in zip(pd_ids, pd_names, pd_patrols.tolist()):
+        policeDistricts[pd_id] = {'id':pd_id,'name':pd_name,'total_patrols':pd_total}
+        district_patrols[dist_idx[pd_id]] = pd_total
+
+    # The solved plan replaces the one in memory as a whole
+    deployments = solution
+
+    # Calculate the distance cost and community totals of the solved plan with whole-matrix reductions
+    distanceCost = float(np.einsum('ij,ij->', deployments, distance_matrix))
+    deploy_totals = deployments.sum(axis=1, dtype=np.int32)
+
+    # Calculate the total coverage of Crimes
+    # Weighted crimes are unchanged since the plan was loaded, only the deployed total is new
+    total_deploys = int(deploy_totals.sum())
+    totalCoverage = calculateTotalCoverage(total_deploys, total_weighted_crimes)
+
+    # Calculate the deployment Fairness
+    fairness = calculateFairness(ethnicity_mask, deploy_totals)
+
+    # Keep the optimized plan across worker restarts
+    savePlanSnapshot()
+
+    # The optimized plan is serialized into the plan response cache right away
+    # The dashboard fetches the loaded plan after an optimization, which then reuses these bytes
+    payload = planPayload()
+    cached_plan_response = orjson.dumps(payload, option=orjson_options)
+
+    result = dict(payload)
+    result.update({'solve_status':solve_status,'message':'Optimization executed succesfully.'})
+    return result
+
+# Starts the optimization model on the deployment plan
+# The solver runs in the background and its result is fetched with optimizationStatus
 class runOptimization(Resource):
+    method_decorators = [withPlanLock]
+
     def get(self):
 
+        global date
+        global period
+        global loaded
         global communities
         global policeDistricts
-        global distances
+        global comm_ids
+        global comm_idx
+        global dist_ids
+        global dist_idx
+        global distance_matrix
+        global district_patrols
+        global ethnicity_mask
         global deployments
+        global deploy_totals
         global crimecounts
+        global comm_codes
+        global coverage_scale
         global totalCoverage
-        global mapCoverage
+        global total_weighted_crimes
+        global total_deploys
         global mapCrimes
-        global mapDeploys
         global distanceCost
         global fairness
+        global cached_plan_response
         global n_crimes_per_patrol
         global crimetype_weights
+        global optimization_jobs
 
-        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distances is None) or not loaded:
+        if (deployments is None) or (communities is None) or (policeDistricts is None) or (distance_matrix is None) or not loaded:
             return {'message':'No deployment plan loaded.','result':'failed'}
 
         # Get the passed arguments
-        argparser = reqparse.RequestParser()
-        argparser.add_argument('useFairness')
-        argparser.add_argument('minOnePatrolPerComm')
-        args = argparser.parse_args()
+        args = optimization_parser.parse_args()
 
-        if json.loads(args['useFairness']) == 'yes':
+        if args['useFairness'] == 'yes':
             useFairness = True
         else:
             useFairness = False
 
-        if json.loads(args['minOnePatrolPerComm']) == 'yes':
+        if args['minOnePatrolPerComm'] == 'yes':
             minOnePatrolPerComm = True
         else:
             minOnePatrolPerComm = False
 
-        print("Building model...")
-        # Create model
-        context = Context.make_default_context()
-        model = Model(name="CrimeDeployment", context=context)
-
-        print("Creating variables...")
-        # Create model variables
-        # Assignment of patrols from each district to each community is a separate variable
-        deployments_cpx = {}
-        deployed_cpx = defaultdict(int)
-        ethnicity_count = {0: 0, 1: 0}
-        for community in communities:
-            comm_id = communities[community]['id']
-            deployments_cpx[comm_id] = {'total': 0}
-            if (communities[community]['ethnicity'] == 0) or (communities[community]['ethnicity'] == 1):
-                ethnicity_count[1] += 1
-            else:
-                ethnicity_count[0] += 1
-            for district in policeDistricts:
-                dist_id = policeDistricts[district]['id']
-                max_patrols = policeDistricts[district]['total_patrols']
-                deployments_cpx[comm_id][dist_id] = model.integer_var(lb=0, ub=max_patrols, name="c"+str(comm_id)+"d"+str(dist_id))
-                deployed_cpx[dist_id] += deployments_cpx[comm_id][dist_id]
-                deployments_cpx[comm_id]['total'] += deployments_cpx[comm_id][dist_id]
-
-        print("Creating constraints...")
-        # Add model constraints
-        # Sum of deployed units over all communities can't be higher than number of available patrols
-        for district in policeDistricts:
-            dist_id = policeDistricts[district]['id']
-            max_patrols = policeDistricts[district]['total_patrols']
-            model.add_constraint(deployed_cpx[dist_id] <= max_patrols)
-            model.add_constraint(deployed_cpx[dist_id] >= 0)
-
-        # At least one patrol per community
-        if minOnePatrolPerComm:
-            for community in communities:
-                comm_id = communities[community]['id']
-                model.add_constraint(deployments_cpx[comm_id]['total'] >= 1)
-
-        print("Calculating objective...")
-        print("     - Crime Coverage")
-        # Calculate crime coverage in this deployment
-        # We check the coverage, but also apply a penalty for coverages larger than a set threshold
-        coverages = []
-        totalDeployed = []
-        totalCrimes = []
-        penalties = []
-        ethnicityDeployed = {0: [], 1: []}
-        for community in communities:
-            if crimecounts[communities[community]['code']]['weighted_count'] != 0:
-                coverage = ((deployments_cpx[community]['total']*n_crimes_per_patrol)/crimecounts[communities[community]['code']]['weighted_count'])
-                coverages.append(coverage)
-                penalty = model.max(0,coverage-(upper_penalty_threshold/100))+model.max(0,(lower_penalty_threshold/100)-coverage)
-                penalties.append(penalty)
-                totalDeployed.append(deployments_cpx[community]['total']*n_crimes_per_patrol)
-                totalCrimes.append(crimecounts[communities[community]['code']]['weighted_count'])
-                if (communities[community]['ethnicity'] == 0) or (communities[community]['ethnicity'] == 1):
-                    ethnicityDeployed[1].append(deployments_cpx[community]['total'])
-                else:
-                    ethnicityDeployed[0].append(deployments_cpx[community]['total'])
-
-        avg_coverage = sum(coverages)/len(coverages)
-        avg_penalty = sum(penalties)/len(penalties)
-        citywideCoverage = sum(totalDeployed)/sum(totalCrimes)
-        citywidePenalty = model.max(0,citywideCoverage-(upper_penalty_threshold/100))+model.max(0,(lower_penalty_threshold/100)-citywideCoverage)
-        fairness = model.abs((sum(ethnicityDeployed[0])/ethnicity_count[0])-(sum(ethnicityDeployed[1])/ethnicity_count[1]))
-
-        print("     - Distances")
-        # Calculate the distances units have to drive to fulfill deployments
-        distances_cpx = []
-        for comm in deployments_cpx:
-            for dist in deployments_cpx[comm]:
-                if (dist != 'total'):
-                    distance = distances[(dist,comm)]*deployments_cpx[comm][dist]
-                    distances_cpx.append(distance)
-        distanceCost_cpx = sum(distances_cpx)
-
-        print("     - Combined Objective")
-        # Now build the objective function
-        obj = 1000000000*citywidePenalty-1000000000*citywideCoverage+1000000*avg_penalty-100000*avg_coverage+distanceCost_cpx
-        if useFairness:
-            print("     - Add Fairness Statistic to Combined Objective")
-            # Add model objective
-            # First calculate the fairness of the deployment
-            obj = 10000*fairness+obj
-
-        #model.add(maximize(obj))
-        model.minimize(obj)
-
-        print("Adding KPIs...")
-        # Add the KPIs we're interested in tracking
-        model.add_kpi(citywideCoverage, publish_name="City-wide Coverage")
-        model.add_kpi(citywidePenalty, publish_name="City-wide Coverage Penalty")
-        model.add_kpi(avg_coverage, publish_name="Avg. Coverage")
-        model.add_kpi(avg_penalty, publish_name="Avg. Coverage Penalty")
-        model.add_kpi(distanceCost_cpx, publish_name="Total Distance")
-        if useFairness:
-            model.add_kpi(fairness, publish_name="Fairness Simple Mean Difference")
-        model.add_kpi(obj, publish_name="Combined Objective")
-
-        print("Model ready:")
-        model.print_information()
-
-        print("Solving problem...")
-        # Solve the problem
-        msol = model.solve()
-
-        print("Done! Getting results...")
-        # Get result from solve
-        # if msol.solve_details['status']:
-        #     return {'solve_status':msol.get_solve_status(),'message':'Optimization executed but aborted due to exceeding maximum run time.','result':'failed'}
-
-        # Get solution and place in deployments
-        model.report()
-        print(msol.solve_details)
-
-        # First reset any plan existing in memory and its KPIs
-        deployments = {}
-        mapCoverage = {}
-        mapDeploys = {}
-        totalCoverage = 0
-        distanceCost = 0
-        fairness = 0
-        for pd in db.session.query(PoliceDistrict):
-            policeDistricts[pd.id] = {'id':pd.id,'name':pd.name,'total_patrols':pd.patrols,'available_patrols':pd.patrols,'deployed_patrols':0}
-
-        for community in communities:
-            comm_id = communities[community]['id']
-            deployments[comm_id] = defaultdict(int)
-            deployments[comm_id]['total'] = 0
-            for district in policeDistricts:
-                dist_id = policeDistricts[district]['id']
-                n_patrols = msol['c'+str(comm_id)+'d'+str(dist_id)]
-                deployments[comm_id][dist_id] += n_patrols
-                deployments[comm_id]['total'] += n_patrols
-                policeDistricts[dist_id]['available_patrols'] -= n_patrols
-                policeDistricts[dist_id]['deployed_patrols'] += n_patrols
-                if crimecounts[communities[comm_id]['code']]['weighted_count'] != 0:
-                    mapCoverage[communities[comm_id]['code']] = ((deployments[comm_id]['total']*n_crimes_per_patrol)/ \
-                                                                crimecounts[communities[comm_id]['code']]['weighted_count'])*100
-                else:
-                    mapCoverage[communities[comm_id]['code']] = 0
-                mapDeploys[communities[comm_id]['code']] = deployments[comm_id]['total']
-                distanceCost += n_patrols*distances[(dist_id,comm_id)]
+        # Snapshot the plan the model is built from
+        # Patrols can still be deployed while the solver runs, but the solution is then discarded instead of applied
+        plan = {'date':date,'period':period,'communities':communities,'policeDistricts':dict(policeDistricts),
+                'comm_ids':comm_ids,'dist_ids':dist_ids,'dist_idx':dist_idx,'distance_matrix':distance_matrix,
+                'district_patrols':district_patrols.copy(),'ethnicity_mask':ethnicity_mask,
+                'deployments':deployments.copy(),'crimecounts':crimecounts}
 
-        # Calculate the total coverage of Crimes
-        totalcrimes = 0
-        totaldeploys = 0
-        for comm in deployments:
-            totalcrimes += crimecounts[communities[comm]['code']]['weighted_count']
-            totaldeploys += deployments[comm]['total']
-            totalCoverage = ((totaldeploys*n_crimes_per_patrol)/totalcrimes)*100
+        # Drop the oldest finished jobs nobody fetched, so abandoned results are not kept for the life of the worker
+        finished_jobs = [old_job_id for old_job_id, old_job in list(optimization_jobs.items()) if old_job.done()]
+        for old_job_id in finished_jobs[:max(0, len(optimization_jobs)+1-max_optimization_jobs)]:
+            optimization_jobs.pop(old_job_id, None)
 
-        # Calculate the deployment Fairness
-        # First calculate the t-statistic
-        t_stat, df = calculateFairnessTStat(communities, deployments)
-        # Now assign the p-value as the fairness
-        fairness = (1 - t.cdf(abs(t_stat), df)) * 2
-        # Convert to percentage value
-        fairness = fairness * 100
+        job_id = uuid.uuid4().hex
+        optimization_jobs[job_id] = optimization_executor.submit(solveOptimization, plan, useFairness, minOnePatrolPerComm)
+
+        return {'job':job_id,'message':'Optimization started.','result':'success'}
+
+# Returns the state of an optimization job, and its result once it has finished
+# Not guarded by the plan lock, so polling does not wait on a solution being applied
+class optimizationStatus(Resource):
+    def get(self):
+
+        global optimization_jobs
+
+        args = optimization_status_parser.parse_args()
+
+        if args['job'] is None:
+            return {'message':'Missing job argument. Please pass the job returned when starting the optimization.','result':'failed'}
+
+        job_id = args['job']
+        job = optimization_jobs.get(job_id)
+        if job is None:
+            return {'message':'Unknown optimization job.','result':'failed'}
+
+        if not job.done():
+            return {'status':'running','message':'Optimization is still running.','result':'success'}
+
+        # Finished jobs are only reported once, concurrent polls of the same job get it removed only once
+        if optimization_jobs.pop(job_id, None) is None:
+            return {'message':'Unknown optimization job.','result':'failed'}
+        try:
+            result = job.result()
+        except Exception:
+            application.logger.exception('Optimization job %s failed.', job_id)
+            result = {'message':'Error running the optimization model.','result':'failed'}
+        result['status'] = 'finished'
+        return result
 
-        return {'communities':communities,'districts':policeDistricts,'mapCoverage':mapCoverage,
-                'mapCrimes':mapCrimes,'mapDeploys':mapDeploys,'distanceCost':distanceCost,
-                'fairness':fairness,'totalCoverage':totalCoverage,
-                'solve_status':msol.solve_details.status,
-                'message':'Optimization executed succesfully.','result':'success'}
 
+# Restore the last plan this worker had loaded, if a snapshot exists
+loadPlanSnapshot()
 
 # Set API resources and endpoints
 api.add_resource(checkService, '/')
@@ -768,8 +1300,10 @@ api.add_resource(getLoadedDeploymentPlan,'/getLoadedDeploymentPlan')
 api.add_resource(loadDeploymentPlan, '/loadDeploymentPlan')
 api.add_resource(deployPatrols, '/deployPatrols')
 api.add_resource(undeployPatrols, '/undeployPatrols')
+api.add_resource(deployPatrolsBatch, '/deployPatrolsBatch')
 api.add_resource(saveDeploymentPlan, '/saveDeploymentPlan')
 api.add_resource(runOptimization, '/runOptimization')
+api.add_resource(optimizationStatus, '/optimizationStatus')
 
 if __name__ == '__main__':
     application.run(debug=True, port=61000)
@@ -0,0 +1,17 @@
+# Gunicorn configuration for the Police Deployment Optimization Service
+# Started by the Procfile. Elastic Beanstalk only reads the Procfile on its Amazon Linux 2 Python platforms;
+# the legacy python-3.6 platform set in .elasticbeanstalk/config.yml serves application.py through
+# Apache and mod_wsgi and ignores both files, so they take effect once the environment moves to Amazon Linux 2
+import multiprocessing
+
+# The deployment plan is kept in process memory, so a single worker process serves all requests
+# Concurrency comes from threads, which share the plan under its lock
+# Loading a plan reads the Machine Learning service and the database, and optimizations run the solver, outside the lock
+workers = 1
+worker_class = 'gthread'
+threads = 2*multiprocessing.cpu_count()+1
+
+bind = '127.0.0.1:8000'
+
+# Optimizations run in the background, but loading a plan waits on the Machine Learning service with retries
+timeout = 300